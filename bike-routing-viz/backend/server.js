@@ -35,17 +35,32 @@ app.get('/health', (req, res) => {
 // Get random nodes for testing
 app.get('/api/nodes/random', async (req, res) => {
     try {
-        const result = await pool.query(`
+        // Sample ~1% of the table's pages rather than sorting every vertex
+        let result = await pool.query(`
             SELECT 
                 id,
                 ST_Y(the_geom) as lat,
                 ST_X(the_geom) as lon
-            FROM ways_vertices_pgr
+            FROM ways_vertices_pgr TABLESAMPLE SYSTEM (1)
             WHERE cnt >= 3
             ORDER BY RANDOM()
             LIMIT 2;
         `);
         
+        // Small graphs can come back with too few sampled rows
+        if (result.rows.length < 2) {
+            result = await pool.query(`
+                SELECT 
+                    id,
+                    ST_Y(the_geom) as lat,
+                    ST_X(the_geom) as lon
+                FROM ways_vertices_pgr
+                WHERE cnt >= 3
+                ORDER BY RANDOM()
+                LIMIT 2;
+            `);
+        }
+        
         res.json(result.rows);
     } catch (error) {
         console.error('Error fetching random nodes:', error);
@@ -11,7 +11,7 @@ echo -e "WARNING: This will delete ALL data!"
 echo -e "==========================================${NC}"
 echo ""
 echo "This will remove:"
-echo "  - OSM routing data (ways, vertices)"
+echo "  - OSM routing data (ways, vertices, ways_costed view)"
 echo "  - Elevation data (rasters, vertex/segment tables)"
 echo "  - Crash incident data"
 echo ""
@@ -26,6 +26,9 @@ echo ""
 echo -e "${YELLOW}Cleaning up all data tables...${NC}"
 
 docker exec -i bike-routing-db psql -U postgres -d bike_routing <<-EOSQL
+    -- Drop derived routing views
+    DROP MATERIALIZED VIEW IF EXISTS ways_costed;
+    
     -- Drop OSM tables
     DROP TABLE IF EXISTS ways CASCADE;
     DROP TABLE IF EXISTS ways_vertices_pgr CASCADE;
@@ -39,10 +39,15 @@ docker exec bike-routing-db osm2pgrouting \
 
 echo -e "${GREEN}✓ OSM data imported${NC}"
 
-echo -e "${YELLOW}Indexing ways(source) and ways(target)...${NC}"
+echo -e "${YELLOW}Indexing ways(source, target) and ways(target, source)...${NC}"
 docker exec -i bike-routing-db psql -U postgres -d bike_routing <<-EOSQL
-    CREATE INDEX IF NOT EXISTS idx_ways_source ON ways(source);
-    CREATE INDEX IF NOT EXISTS idx_ways_target ON ways(target);
+    -- Composite indexes cover both edge directions (and single-column lookups)
+    CREATE INDEX IF NOT EXISTS idx_ways_source_target ON ways(source, target);
+    CREATE INDEX IF NOT EXISTS idx_ways_target_source ON ways(target, source);
+    
+    -- Store edges in source order so graph scans read them sequentially
+    CLUSTER ways USING idx_ways_source_target;
+    ANALYZE ways;
 EOSQL
 
 echo -e "${GREEN}✓ Indexing complete${NC}"
@@ -9,6 +9,7 @@ NC='\033[0m'
 # Clean up existing elevation data
 echo -e "${YELLOW}Cleaning up existing elevation tables...${NC}"
 docker exec -i bike-routing-db psql -U postgres -d bike_routing <<-EOSQL
+    DROP MATERIALIZED VIEW IF EXISTS ways_costed;
     DROP TABLE IF EXISTS elevation CASCADE;
     DROP TABLE IF EXISTS vertex_elevation CASCADE;
     DROP TABLE IF EXISTS segment_elevation CASCADE;
@@ -102,6 +103,41 @@ EOSQL
 
 echo -e "${GREEN}✓ Segment grades calculated${NC}"
 
+echo -e "${YELLOW}Building ways_costed routing view...${NC}"
+docker exec -i bike-routing-db psql -U postgres -d bike_routing <<-EOSQL
+    -- Pre-join per-edge routing inputs so pgr_dijkstra scans a single relation
+    DROP MATERIALIZED VIEW IF EXISTS ways_costed;
+    
+    CREATE MATERIALIZED VIEW ways_costed AS
+    SELECT 
+        w.gid AS id,
+        w.source,
+        w.target,
+        w.length_m AS cost_fast,
+        w.length_m * c.priority *
+            (1 + COALESCE(CASE WHEN se.grade_percent > 0 THEN se.grade_percent * 0.3 ELSE 0 END, 0)) AS cost_safe,
+        w.the_geom,
+        w.name,
+        w.length_m,
+        c.tag_value,
+        se.elevation_start_m,
+        se.elevation_end_m,
+        se.elevation_change_m,
+        se.grade_percent
+    FROM ways w
+    JOIN configuration c ON w.tag_id = c.tag_id
+    LEFT JOIN segment_elevation se ON w.gid = se.segment_id
+    ORDER BY w.source, w.target;
+    
+    CREATE UNIQUE INDEX idx_ways_costed_id ON ways_costed(id);
+    CREATE INDEX idx_ways_costed_source_target ON ways_costed(source, target);
+    CREATE INDEX idx_ways_costed_target_source ON ways_costed(target, source);
+    
+    ANALYZE ways_costed;
+EOSQL
+
+echo -e "${GREEN}✓ Routing view built${NC}"
+
 echo -e "${YELLOW}Gathering elevation statistics...${NC}"
 docker exec -i bike-routing-db psql -U postgres -d bike_routing <<-EOSQL
     SELECT 
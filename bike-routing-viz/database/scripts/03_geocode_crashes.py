@@ -4,70 +4,124 @@ Geocode crash data using ESRI ArcGIS API
 """
 import os
 import sys
+import json
+import math
 import requests
+import numpy as np
 import pandas as pd
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import re
+import shelve
 
 # Configuration
 ESRI_API_KEY = os.environ.get('ESRI_API_KEY', '')
 INPUT_FILE = '../data/crash_data.csv'
 OUTPUT_FILE = '../data/crash_data_geocoded.csv'
 ESRI_GEOCODE_URL = 'https://geocode-api.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates'
+ESRI_BATCH_GEOCODE_URL = 'https://geocode-api.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses'
+CACHE_FILE = '../data/geocode_cache.db'
 
-def parse_location_components(on_street, at_street):
-    """Parse location strings and extract components"""
-    on_street = str(on_street) if pd.notna(on_street) else ''
-    at_street = str(at_street) if pd.notna(at_street) else ''
-    
-    result = {
-        'location_type': None,
-        'street1': None,
-        'street2': None,
-        'direction': None,
-        'block_number': None,
-        'address': None
-    }
+# Columns geocode_chunk adds after the input columns
+GEOCODE_COLUMNS = [
+    'location_type', 'parsed_street1', 'parsed_street2', 'latitude', 'longitude',
+    'geocode_query', 'geocode_confidence', 'matched_address', 'esri_score'
+]
+BATCH_SIZE = 150
+MAX_WORKERS = 4  # ESRI recommends at most 4 simultaneous batch requests
+CHECKPOINT_SIZE = BATCH_SIZE * MAX_WORKERS  # rows geocoded between output checkpoints
+
+# Reuse connections across requests and worker threads
+session = requests.Session()
+# Only back off when ESRI asks us to (429) or is struggling (5xx); honours Retry-After
+retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['GET', 'POST']
+)
+session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retry))
+
+# Location parsing patterns, compiled once rather than per row
+_DIRECTION_RE = re.compile(r'^(NORTH OF|SOUTH OF|EAST OF|WEST OF)\s+(.+)', re.IGNORECASE)
+_BLK_RE = re.compile(r'^BLK\s+(\d+)\s+(.+)', re.IGNORECASE)
+_AND_RE = re.compile(r'\s+AND\s+', re.IGNORECASE)
+_LEADING_DIGIT_RE = re.compile(r'^\d+')
+_PREFIX_STRIP_RE = re.compile(r'\b(CST|PP|ALY)\s+')
+_STRIP_AT_RE = re.compile(r'(PARKING LOT AT|AT)\s*', re.IGNORECASE)
+_PARKING_RE = re.compile(r'PARKING LOT AT (.+?)(?:\s+EXIT)?$', re.IGNORECASE)
+
+def parse_locations(on_streets, at_streets):
+    """Parse location strings and extract components for a whole Series at once"""
+    on_clean = on_streets.fillna('').astype(str).str.strip()
+    at_clean = at_streets.fillna('').astype(str).str.strip()
+    at_upper = at_clean.str.upper()
     
-    on_clean = on_street.strip()
-    direction_match = re.match(r'^(NORTH OF|SOUTH OF|EAST OF|WEST OF)\s+(.+)', on_clean, re.IGNORECASE)
-    if direction_match:
-        result['direction'] = direction_match.group(1)
-        on_clean = direction_match.group(2)
-    
-    blk_match = re.match(r'^BLK\s+(\d+)\s+(.+)', on_clean, re.IGNORECASE)
-    if blk_match:
-        result['block_number'] = blk_match.group(1)
-        result['street1'] = blk_match.group(2).replace('CST ', '').replace('PP ', '').strip()
-        result['location_type'] = 'block'
-    else:
-        on_clean = on_clean.replace('CST ', '').replace('PP ', '').replace('ALY ', '').strip()
-        result['street1'] = on_clean
-    
-    at_clean = at_street.strip()
-    if at_clean.upper().startswith('BTWN'):
-        result['location_type'] = 'between'
-        between_str = at_clean.replace('BTWN ', '').replace('CST ', '').replace('PP ', '')
-        if ' AND ' in between_str.upper():
-            parts = re.split(r'\s+AND\s+', between_str, flags=re.IGNORECASE)
-            result['street2'] = parts[0].strip() if len(parts) > 0 else None
-    elif re.match(r'^\d+', at_clean):
-        result['location_type'] = 'address'
-        address_clean = re.sub(r'(PARKING LOT AT|AT)\s*', '', at_clean, flags=re.IGNORECASE).strip()
-        result['address'] = address_clean
-    elif at_clean and at_clean.upper() not in ['ALLEY', '']:
-        at_clean = at_clean.replace('CST ', '').replace('PP ', '').replace('ALY ', '').strip()
-        if at_clean.upper() != 'ALLEY':
-            result['street2'] = at_clean
-            if not result['location_type']:
-                result['location_type'] = 'intersection'
-    
-    return result
+    direction_match = on_clean.str.extract(_DIRECTION_RE)
+    on_clean = direction_match[1].where(direction_match[0].notna(), on_clean)
+    
+    blk_match = on_clean.str.extract(_BLK_RE)
+    is_block = blk_match[0].notna()
+    street1 = blk_match[1].where(is_block, on_clean)
+    street1 = street1.str.replace(_PREFIX_STRIP_RE, '', regex=True).str.strip()
+    
+    is_between = at_upper.str.startswith('BTWN')
+    between_str = at_clean.str.replace('BTWN ', '', regex=False).str.replace(_PREFIX_STRIP_RE, '', regex=True)
+    has_and = between_str.str.upper().str.contains(' AND ', regex=False)
+    between_street = between_str.str.split(_AND_RE, n=1).str[0].str.strip()
+    
+    is_address = ~is_between & at_clean.str.match(_LEADING_DIGIT_RE)
+    address = at_clean.str.replace(_STRIP_AT_RE, '', regex=True).str.strip()
+    
+    cross_street = at_clean.str.replace(_PREFIX_STRIP_RE, '', regex=True).str.strip()
+    is_intersection = (
+        ~is_between & ~is_address
+        & (at_clean != '') & (at_upper != 'ALLEY')
+        & (cross_street.str.upper() != 'ALLEY')
+    )
+    
+    result = pd.DataFrame({
+        # Later location types take precedence, except intersections never replace blocks
+        'location_type': np.select(
+            [is_between, is_address, is_block, is_intersection],
+            ['between', 'address', 'block', 'intersection'],
+            default=None
+        ),
+        'street1': street1,
+        'street2': between_street.where(is_between & has_and, cross_street.where(is_intersection)),
+        'direction': direction_match[0],
+        'block_number': blk_match[0],
+        'address': address.where(is_address)
+    }, index=on_streets.index)
+    
+    return result.astype(object).where(result.notna(), None)
 
 def build_esri_query(components):
     """Build ESRI geocode query from parsed components"""
     loc_type = components['location_type']
     
+    # Intersection query (the most common case, so check it first)
+    if loc_type == 'intersection' and components['street1'] and components['street2']:
+        # Special case: If street2 is a parking lot description, extract the landmark
+        # (crash reports are upper-case, so skip upper() on every intersection)
+        if 'PARKING LOT' in components['street2']:
+            # Try to extract the landmark name (e.g., "UNION STATION")
+            landmark_match = _PARKING_RE.search(components['street2'])
+            if landmark_match:
+                landmark = landmark_match.group(1).strip()
+                # Geocode to the landmark location
+                return {
+                    'SingleLine': f"{landmark}, St Louis, MO",
+                    'category': 'POI,Address'
+                }
+        
+        # Regular intersection
+        return {
+            'SingleLine': f"{components['street1']} & {components['street2']}, St Louis, MO",
+            'category': 'Street Address,Address'
+        }
+    
     # Address query
     if loc_type == 'address' and components['address']:
         return {
@@ -91,26 +145,6 @@ def build_esri_query(components):
             'category': 'Address'
         }
     
-    # Intersection query
-    if loc_type == 'intersection' and components['street1'] and components['street2']:
-        # Special case: If street2 is a parking lot description, extract the landmark
-        if 'PARKING LOT' in components['street2'].upper():
-            # Try to extract the landmark name (e.g., "UNION STATION")
-            landmark_match = re.search(r'PARKING LOT AT (.+?)(?:\s+EXIT)?$', components['street2'], re.IGNORECASE)
-            if landmark_match:
-                landmark = landmark_match.group(1).strip()
-                # Geocode to the landmark location
-                return {
-                    'SingleLine': f"{landmark}, St Louis, MO",
-                    'category': 'POI,Address'
-                }
-        
-        # Regular intersection
-        return {
-            'SingleLine': f"{components['street1']} & {components['street2']}, St Louis, MO",
-            'category': 'Street Address,Address'
-        }
-    
     # Fallback to just street1
     if components['street1'] and len(components['street1']) > 3:
         return {
@@ -120,8 +154,54 @@ def build_esri_query(components):
     
     return None
 
-def geocode_with_esri(query_params):
-    """Geocode using ESRI ArcGIS World Geocoding Service"""
+def cache_key(query_params):
+    """Normalize a query so repeated addresses share a cache entry"""
+    return query_params['SingleLine'].upper().strip()
+
+def is_match(location):
+    """Check whether an ESRI candidate/location actually matched an address
+    
+    Unmatched batch records come back with a zero score and "NaN" coordinates
+    rather than being left out of the response.
+    """
+    point = location.get('location') or {}
+    coords = [point.get('x'), point.get('y')]
+    return bool(location.get('score')) and all(
+        isinstance(coord, (int, float)) and math.isfinite(coord) for coord in coords
+    )
+
+def parse_candidate(candidate):
+    """Convert an ESRI candidate/location into a geocode result"""
+    location = candidate.get('location', {})
+    
+    lon = location.get('x')
+    lat = location.get('y')
+    score = candidate.get('score', 0)
+    matched_address = candidate.get('address', '')
+    addr_type = candidate.get('attributes', {}).get('Addr_type', '')
+    
+    if score >= 90:
+        confidence = 'high'
+    elif score >= 75:
+        confidence = 'medium'
+    else:
+        confidence = 'low'
+    
+    return {
+        'lat': lat,
+        'lon': lon,
+        'confidence': confidence,
+        'matched_address': matched_address,
+        'score': score,
+        'addr_type': addr_type
+    }
+
+def geocode_with_esri(session, query_params):
+    """Geocode using ESRI ArcGIS World Geocoding Service
+    
+    Returns the best candidate's result, an empty dict if ESRI found no
+    match, or None if the request itself failed.
+    """
     if not query_params:
         return None
     
@@ -130,7 +210,7 @@ def geocode_with_esri(query_params):
         'token': ESRI_API_KEY,
         'outFields': 'Match_addr,Addr_type,Score',
         'maxLocations': 1,
-        'forStorage': False,
+        'forStorage': True,  # results are kept in the geocode cache
         'location': '-90.1994,38.6270',
         'searchExtent': '-90.5,38.5,-90.0,38.85'
     }
@@ -141,42 +221,154 @@ def geocode_with_esri(query_params):
     params.update(query_params)
     
     try:
-        response = requests.get(ESRI_GEOCODE_URL, params=params)
+        response = session.get(ESRI_GEOCODE_URL, params=params)
         response.raise_for_status()
         data = response.json()
         
+        if 'error' in data:
+            print(f"ESRI API Error: {data['error'].get('message', data['error'])}")
+            return None
+        
         if data.get('candidates') and len(data['candidates']) > 0:
-            candidate = data['candidates'][0]
-            location = candidate.get('location', {})
-            
-            lon = location.get('x')
-            lat = location.get('y')
-            score = candidate.get('score', 0)
-            matched_address = candidate.get('address', '')
-            addr_type = candidate.get('attributes', {}).get('Addr_type', '')
-            
-            if score >= 90:
-                confidence = 'high'
-            elif score >= 75:
-                confidence = 'medium'
-            else:
-                confidence = 'low'
-            
-            return {
-                'lat': lat,
-                'lon': lon,
-                'confidence': confidence,
-                'matched_address': matched_address,
-                'score': score,
-                'addr_type': addr_type
-            }
+            return parse_candidate(data['candidates'][0])
         else:
+            return {}
+            
+    except requests.exceptions.RequestException as e:
+        print(f"ESRI API Error: {e}")
+        return None
+
+def geocode_batch_with_esri(session, records, category):
+    """Geocode a batch of {OBJECTID, SingleLine} records in one request
+    
+    Returns a dict of OBJECTID -> result, with an empty dict for records
+    ESRI could not match, or None if the batch request itself failed.
+    """
+    if not records:
+        return {}
+    
+    params = {
+        'f': 'json',
+        'token': ESRI_API_KEY,
+        'addresses': json.dumps({'records': [{'attributes': record} for record in records]}),
+        'category': category,
+        'outFields': 'Match_addr,Addr_type,Score,Status',
+        'forStorage': True,
+        'location': '-90.1994,38.6270',
+        'searchExtent': '-90.5,38.5,-90.0,38.85'
+    }
+    
+    if (params['token'] == ''): 
+        raise ValueError("The environment value ESRI_API_KEY has not been set.")
+    
+    try:
+        response = session.post(ESRI_BATCH_GEOCODE_URL, data=params)
+        response.raise_for_status()
+        data = response.json()
+        
+        if 'error' in data:
+            print(f"ESRI API Error: {data['error'].get('message', data['error'])}")
             return None
+        
+        results = {}
+        for location in data.get('locations', []):
+            attributes = location.get('attributes', {})
+            if attributes.get('Status') == 'U' or not is_match(location):
+                results[attributes.get('ResultID')] = {}
+            else:
+                results[attributes.get('ResultID')] = parse_candidate(location)
+        return results
             
     except requests.exceptions.RequestException as e:
         print(f"ESRI API Error: {e}")
         return None
 
+def geocode_chunk(df, cache, executor):
+    """Parse and geocode a slice of crash rows, adding the geocoding columns"""
+    df = df.copy()
+    
+    # Many crashes share a location, so parse each distinct street pair once
+    location_keys = df['On Street'].fillna('') + '|' + df['At Street'].fillna('')
+    first_seen = ~location_keys.duplicated()
+    locations = df.loc[first_seen, ['On Street', 'At Street']].set_axis(location_keys[first_seen])
+    
+    components = parse_locations(locations['On Street'], locations['At Street'])
+    query_params = components.apply(build_esri_query, axis=1)
+    
+    # Spread the parsed results back out to every crash row
+    components = components.loc[location_keys].set_axis(df.index)
+    query_params = query_params.loc[location_keys].set_axis(df.index)
+    keys = query_params.map(cache_key, na_action='ignore')
+    
+    # Crash locations repeat heavily, so only geocode each distinct query once
+    queries = {}
+    for key, params in zip(keys, query_params):
+        if params:
+            queries.setdefault(key, params)
+    
+    # No-matches are cached as empty results, so they aren't requested again
+    results = {key: cache[key] for key in queries if key in cache}
+    misses = [key for key in queries if key not in results]
+    
+    # Batch requests share a category, so group the records by it
+    records_by_category = {}
+    for object_id, key in enumerate(misses):
+        params = queries[key]
+        records_by_category.setdefault(params['category'], []).append(
+            {'OBJECTID': object_id, 'SingleLine': params['SingleLine']}
+        )
+    
+    batches = [
+        (category, records[start:start + BATCH_SIZE])
+        for category, records in records_by_category.items()
+        for start in range(0, len(records), BATCH_SIZE)
+    ]
+    
+    batch_futures = {
+        executor.submit(geocode_batch_with_esri, session, batch, category): (category, batch)
+        for category, batch in batches
+    }
+    single_futures = {}
+    
+    for future in as_completed(batch_futures):
+        category, batch = batch_futures[future]
+        batch_results = future.result()
+        
+        # Fall back to single-address requests if the batch endpoint is unavailable
+        if batch_results is None:
+            for record in batch:
+                params = queries[misses[record['OBJECTID']]]
+                single_futures[executor.submit(geocode_with_esri, session, params)] = record['OBJECTID']
+            continue
+        
+        for object_id, result in batch_results.items():
+            key = misses[object_id]
+            results[key] = cache[key] = result
+    
+    for future in as_completed(single_futures):
+        result = future.result()
+        if result is not None:
+            key = misses[single_futures[future]]
+            results[key] = cache[key] = result
+    
+    geocoded = pd.DataFrame(
+        [results.get(key) or {} for key in keys],
+        index=df.index,
+        columns=['lat', 'lon', 'confidence', 'matched_address', 'score']
+    )
+    
+    df['location_type'] = components['location_type']
+    df['parsed_street1'] = components['street1']
+    df['parsed_street2'] = components['street2']
+    df['latitude'] = geocoded['lat']
+    df['longitude'] = geocoded['lon']
+    df['geocode_query'] = query_params.map(lambda params: params['SingleLine'], na_action='ignore')
+    df['geocode_confidence'] = geocoded['confidence']
+    df['matched_address'] = geocoded['matched_address']
+    df['esri_score'] = geocoded['score']
+    
+    return df
+
 def main():
     if not os.path.exists(INPUT_FILE):
         print(f"Error: Input file not found: {INPUT_FILE}")
@@ -186,70 +378,88 @@ def main():
     df = pd.read_csv(INPUT_FILE)
 
     print(f"Loaded {len(df)} records\n")
-
-    # Add geocoding columns
-    df['location_type'] = None
-    df['parsed_street1'] = None
-    df['parsed_street2'] = None
-    df['latitude'] = None
-    df['longitude'] = None
-    df['geocode_query'] = None
-    df['geocode_confidence'] = None
-    df['matched_address'] = None
-    df['esri_score'] = None
+    
+    # Rows already written by an earlier (possibly interrupted) run are kept
+    saved = None
+    if os.path.exists(OUTPUT_FILE):
+        header = list(pd.read_csv(OUTPUT_FILE, nrows=0).columns)
+        if header == list(df.columns) + GEOCODE_COLUMNS:
+            # Read as text so rewritten rows keep their original formatting
+            saved = pd.read_csv(OUTPUT_FILE, dtype=object)
+        else:
+            print(f"{OUTPUT_FILE} has different columns than this script writes; starting over\n")
+    
+    if saved is not None and len(saved) > len(df):
+        print(f"{OUTPUT_FILE} has more rows than {INPUT_FILE}; starting over\n")
+        saved = None
+    
+    done = len(saved) if saved is not None else 0
     
     successful = 0
     failed = 0
     
-    print("Starting geocoding with ESRI ArcGIS...\n")
-    
-    for idx, row in df.iterrows():
-        on_street = row.get('On Street', '')
-        at_street = row.get('At Street', '')
+    with shelve.open(CACHE_FILE) as cache:
+        # Retry rows whose request errored; rows with no query or a cached
+        # no-match would only fail again (and every request is billed)
+        retry_rows = []
+        if saved is not None:
+            unlocated = saved['latitude'].isna() & saved['geocode_query'].notna()
+            retry_rows = [
+                row for row, query in saved.loc[unlocated, 'geocode_query'].items()
+                if cache.get(cache_key({'SingleLine': query})) != {}
+            ]
         
-        components = parse_location_components(on_street, at_street)
-        df.at[idx, 'location_type'] = components['location_type']
-        df.at[idx, 'parsed_street1'] = components['street1']
-        df.at[idx, 'parsed_street2'] = components['street2']
+        if done >= len(df) and not retry_rows:
+            print(f"All {len(df)} records already geocoded in {OUTPUT_FILE} (delete it to start over)")
+            return
         
-        query_params = build_esri_query(components)
+        if done:
+            print(f"Resuming after {done} records already saved to {OUTPUT_FILE} "
+                  f"({len(retry_rows)} to retry)\n")
         
-        if not query_params:
-            failed += 1
-            continue
-        
-        df.at[idx, 'geocode_query'] = query_params.get('SingleLine', '')
+        print("Starting batch geocoding with ESRI ArcGIS...\n")
         
-        result = geocode_with_esri(query_params)
-        
-        if result:
-            df.at[idx, 'latitude'] = result['lat']
-            df.at[idx, 'longitude'] = result['lon']
-            df.at[idx, 'geocode_confidence'] = result['confidence']
-            df.at[idx, 'matched_address'] = result['matched_address']
-            df.at[idx, 'esri_score'] = result['score']
-            successful += 1
-        else:
-            failed += 1
-        
-        if (idx + 1) % 50 == 0:
-            print(f"Progress: {idx + 1}/{len(df)} - {successful} geocoded, {failed} failed")
-            sleep(0.05)
-        
-        if (idx + 1) % 100 == 0:
-            sleep(1)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for start in range(0, len(retry_rows), CHECKPOINT_SIZE):
+                rows = retry_rows[start:start + CHECKPOINT_SIZE]
+                chunk = geocode_chunk(df.loc[rows], cache, executor)
+                
+                # Checkpoint: rewrite the saved rows with the retried results,
+                # replacing the file in one step so a crash can't truncate it
+                saved.loc[rows] = chunk.astype(object)
+                saved.to_csv(OUTPUT_FILE + '.tmp', index=False)
+                os.replace(OUTPUT_FILE + '.tmp', OUTPUT_FILE)
+                cache.sync()
+                
+                geocoded = int(chunk['latitude'].notna().sum())
+                successful += geocoded
+                failed += len(chunk) - geocoded
+                print(f"Retried: {start + len(chunk)}/{len(retry_rows)} - {successful} geocoded, {failed} failed")
+            
+            for start in range(done, len(df), CHECKPOINT_SIZE):
+                chunk = geocode_chunk(df.iloc[start:start + CHECKPOINT_SIZE], cache, executor)
+                
+                # Checkpoint: append this chunk's rows and flush the cache to disk
+                chunk.to_csv(OUTPUT_FILE, mode='w' if start == 0 else 'a', header=(start == 0), index=False)
+                cache.sync()
+                
+                geocoded = int(chunk['latitude'].notna().sum())
+                successful += geocoded
+                failed += len(chunk) - geocoded
+                print(f"Progress: {start + len(chunk)}/{len(df)} - {successful} geocoded, {failed} failed")
     
-    print(f"\nSaving results to {OUTPUT_FILE}...")
-    df.to_csv(OUTPUT_FILE, index=False)
+    processed = successful + failed
     
     print(f"\n{'='*60}")
     print(f"GEOCODING SUMMARY")
     print(f"{'='*60}")
     print(f"Total records: {len(df)}")
+    if done:
+        print(f"Resumed from previous run: {done} (retried {len(retry_rows)})")
     print(f"Successfully geocoded: {successful}")
     print(f"Failed: {failed}")
-    print(f"Success rate: {successful/len(df)*100:.1f}%")
+    print(f"Success rate: {successful/processed*100:.1f}%")
     print(f"\n✓ Geocoding complete")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,12 +5,31 @@ Import geocoded crash data into PostgreSQL database
 import os
 import sys
 import pandas as pd
+import psycopg2
+import psycopg2.extras
 import subprocess
 
 INPUT_FILE = '../data/crash_data_geocoded.csv'
 DB_CONTAINER = 'bike-routing-db'
+DB_HOST = 'localhost'
+DB_PORT = 5432
 DB_NAME = 'bike_routing'
 DB_USER = 'postgres'
+DB_PASSWORD = 'password'
+PAGE_SIZE = 1000
+
+# Only the columns that are imported are loaded from the geocoded CSV
+INPUT_COLUMNS = [
+    'Weekday', 'Date', 'Time', 'Severity', 'At Street', 'On Street', 'Light Cond',
+    'Injured', 'Killed', 'latitude', 'longitude', 'geocode_confidence'
+]
+INPUT_DTYPES = {'Injured': 'Int32', 'Killed': 'Int32', 'On Street': 'string', 'At Street': 'string'}
+
+# CSV columns in crash_incidents insert order (longitude, latitude build the location)
+INSERT_COLUMNS = [
+    'Weekday', 'Date', 'Time', 'Severity', 'At Street', 'On Street', 'Light Cond',
+    'Injured', 'Killed', 'longitude', 'latitude', 'geocode_confidence'
+]
 
 def create_crash_table():
     """Create crash_incidents table if it doesn't exist"""
@@ -75,6 +94,14 @@ def create_crash_table():
     subprocess.run(cmd, input=create_sql.encode(), check=True)
     print("✓ Table created")
 
+def crash_rows(geocoded_df):
+    """Yield insert value tuples one crash at a time"""
+    values = geocoded_df.reindex(columns=INSERT_COLUMNS)
+    values[['Injured', 'Killed']] = values[['Injured', 'Killed']].fillna(0).astype(int)
+    
+    for row in values.itertuples(index=False, name=None):
+        yield tuple(None if pd.isna(val) else val for val in row)
+
 def import_crashes():
     """Import crash data from CSV"""
     if not os.path.exists(INPUT_FILE):
@@ -82,9 +109,9 @@ def import_crashes():
         sys.exit(1)
     
     print(f"Loading geocoded data from {INPUT_FILE}...")
-    df = pd.read_csv(INPUT_FILE)
+    df = pd.read_csv(INPUT_FILE, usecols=INPUT_COLUMNS, dtype=INPUT_DTYPES)
     
-    geocoded_df = df[df['latitude'].notna() & df['longitude'].notna()].copy()
+    geocoded_df = df.dropna(subset=['latitude', 'longitude'])
     
     print(f"Found {len(geocoded_df)} geocoded records out of {len(df)} total")
     
@@ -95,59 +122,42 @@ def import_crashes():
     print("\nConfidence breakdown:")
     print(geocoded_df['geocode_confidence'].value_counts())
     
-    # Generate SQL insert statements
-    print("\nGenerating SQL inserts...")
-    inserts = []
-    
-    for _, row in geocoded_df.iterrows():
-        # Helper function to format values
-        def fmt_str(val):
-            if pd.isna(val):
-                return 'NULL'
-            # Escape single quotes by doubling them
-            return f"'{str(val).replace("'", "''")}'"
-        
-        def fmt_int(val):
-            if pd.isna(val):
-                return '0'
-            return str(int(val))
-        
-        values = [
-            fmt_str(row.get('Weekday')),
-            fmt_str(row.get('Date')),
-            fmt_str(row.get('Time')),
-            fmt_str(row.get('Severity')),
-            fmt_str(row.get('At Street')),
-            fmt_str(row.get('On Street')),
-            fmt_str(row.get('Light Cond')),
-            fmt_int(row.get('Injured')),
-            fmt_int(row.get('Killed')),
-            f"ST_SetSRID(ST_MakePoint({row['longitude']}, {row['latitude']}), 4326)",
-            fmt_str(row.get('geocode_confidence'))
-        ]
-        
-        insert = f"INSERT INTO crash_incidents (weekday, incident_date, incident_time, severity, at_street, on_street, light_cond, injured, killed, location, geocode_confidence) VALUES ({', '.join(values)});"
-        inserts.append(insert)
-    
-    # Import in batches to avoid command length issues
-    sql_content = '\n'.join(inserts)
+    print(f"\nImporting {len(geocoded_df)} records...")
     
-    print(f"Importing {len(inserts)} records...")
-    
-    cmd = [
-        'docker', 'exec', '-i', DB_CONTAINER,
-        'psql', '-U', DB_USER, '-d', DB_NAME
-    ]
-    
-    result = subprocess.run(cmd, input=sql_content.encode(), capture_output=True)
+    try:
+        conn = psycopg2.connect(
+            host=DB_HOST,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            port=DB_PORT
+        )
+    except psycopg2.Error as e:
+        print(f"\nCould not connect to database: {e}")
+        sys.exit(1)
     
-    if result.returncode != 0:
+    try:
+        with conn, conn.cursor() as cur:
+            # Casts are needed because multi-row VALUES types unknown literals as text
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO crash_incidents (weekday, incident_date, incident_time, severity, at_street, on_street, light_cond, injured, killed, location, geocode_confidence)
+                VALUES %s
+                """,
+                crash_rows(geocoded_df),
+                template="(%s, %s::date, %s::time, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s)",
+                page_size=PAGE_SIZE
+            )
+    except psycopg2.Error as e:
         print(f"\nErrors occurred during import:")
-        print(result.stderr)
+        print(e)
         sys.exit(1)
+    finally:
+        conn.close()
     
     print(f"\n{'='*60}")
-    print(f"✓ Successfully imported {len(inserts)} crash records")
+    print(f"✓ Successfully imported {len(geocoded_df)} crash records")
     print(f"{'='*60}")
 
 def main():
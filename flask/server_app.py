@@ -1,61 +1,115 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
+import orjson
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import json
+from contextlib import contextmanager
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize responses with orjson; route GeoJSON payloads can be large"""
+    def dumps(self, obj, **kwargs):
+        # Fall back to Flask's handling for types orjson doesn't know (e.g. Decimal).
+        # Keys stay sorted like Flask's default, but dates and datetimes come out
+        # as ISO 8601 strings instead of Flask's HTTP-date format.
+        option = orjson.OPT_SORT_KEYS if kwargs.get('sort_keys', self.sort_keys) else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  # Allow browser requests
 
-# Database connection
+# Compress large JSON (route GeoJSON, elevation profiles); tiny responses aren't worth it
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
+
+# Database connection pool, shared across requests
+pool = psycopg2.pool.ThreadedConnectionPool(
+    minconn=2,
+    maxconn=16,
+    host="localhost",
+    database="bike_routing",
+    user="postgres",
+    password="password",
+    port=5432
+)
+
+@contextmanager
 def get_db():
-    return psycopg2.connect(
-        host="localhost",
-        database="bike_routing",
-        user="postgres",
-        password="password",
-        port=5432
-    )
+    """Borrow a pooled connection for the duration of a request"""
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def route_cost_column(route_type):
+    """Cost column for a route type (precomputed in ways_costed)"""
+    if route_type == 'safest':
+        return 'cost_safe'
+    return 'cost_fast'  # fastest
 
 @app.route('/api/route', methods=['GET'])
 def get_route():
-    """Calculate route between two nodes"""
+    """Calculate route between two nodes
+    
+    With profile=1 the response also carries the route's elevation profile,
+    so clients don't need a second round trip to /api/elevation-profile.
+    """
     start_node = request.args.get('start', type=int)
     end_node = request.args.get('end', type=int)
     route_type = request.args.get('type', 'fastest')  # 'fastest' or 'safest'
+    include_profile = request.args.get('profile', 0, type=int)
     
     if not start_node or not end_node:
         return jsonify({'error': 'Missing start or end node'}), 400
     
-    # Different cost functions for different route types
-    if route_type == 'safest':
-        cost_formula = '''
-            w.length_m * c.priority * 
-            (1 + COALESCE(
-                CASE WHEN se.grade_percent > 0 THEN se.grade_percent * 0.3 ELSE 0 END, 
-                0
-            ))
-        '''
-    else:  # fastest
-        cost_formula = 'w.length_m'
-    
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cost_column = route_cost_column(route_type)
+    
+    # Only build the per-segment profile array for clients that ask for it
+    profile_member = """,
+                'elevation_profile', json_agg(
+                    json_build_object(
+                        'seq', s.seq,
+                        'name', s.name,
+                        'elevation_start_m', s.elevation_start_m,
+                        'elevation_end_m', s.elevation_end_m,
+                        'grade_percent', s.grade_percent,
+                        'length_m', s.length_m,
+                        'cumulative_distance_m', s.cumulative_distance_m
+                    ) ORDER BY s.seq
+                )""" if include_profile else ''
     
     # Get route with details
     query = f"""
         WITH route AS (
             SELECT * FROM pgr_dijkstra(
-                'SELECT 
-                    w.gid as id, 
-                    w.source, 
-                    w.target,
-                    {cost_formula} as cost
-                 FROM ways w
-                 JOIN configuration c ON w.tag_id = c.tag_id
-                 LEFT JOIN segment_elevation se ON w.gid = se.segment_id',
-                {start_node}, {end_node}, false
+                'SELECT id, source, target, {cost_column} as cost FROM ways_costed',
+                %s, %s, false
             )
+        ),
+        segments AS (
+            SELECT 
+                r.seq,
+                wc.the_geom,
+                wc.name,
+                wc.length_m,
+                wc.tag_value,
+                wc.elevation_start_m,
+                wc.elevation_end_m,
+                wc.elevation_change_m,
+                wc.grade_percent,
+                SUM(wc.length_m) OVER (ORDER BY r.seq) as cumulative_distance_m
+            FROM route r
+            JOIN ways_costed wc ON r.edge = wc.id
+            WHERE r.edge IS NOT NULL
         )
         SELECT 
             json_build_object(
@@ -63,97 +117,108 @@ def get_route():
                 'features', json_agg(
                     json_build_object(
                         'type', 'Feature',
-                        'geometry', ST_AsGeoJSON(w.the_geom)::json,
+                        'geometry', ST_AsGeoJSON(s.the_geom)::json,
                         'properties', json_build_object(
-                            'name', w.name,
-                            'length_m', ROUND(w.length_m::numeric, 2),
-                            'grade_percent', ROUND(COALESCE(se.grade_percent, 0)::numeric, 2),
-                            'elevation_change_m', ROUND(COALESCE(se.elevation_change_m, 0)::numeric, 2),
-                            'road_type', c.tag_value,
-                            'seq', r.seq
+                            'name', s.name,
+                            'length_m', ROUND(s.length_m::numeric, 2),
+                            'grade_percent', ROUND(COALESCE(s.grade_percent, 0)::numeric, 2),
+                            'elevation_change_m', ROUND(COALESCE(s.elevation_change_m, 0)::numeric, 2),
+                            'road_type', s.tag_value,
+                            'seq', s.seq
                         )
-                    )
-                )
-            ) as geojson
-        FROM route r
-        JOIN ways w ON r.edge = w.gid
-        JOIN configuration c ON w.tag_id = c.tag_id
-        LEFT JOIN segment_elevation se ON w.gid = se.segment_id
-        WHERE r.edge IS NOT NULL;
+                    ) ORDER BY s.seq
+                ){profile_member}
+            )::text as geojson,
+            COUNT(*) as segment_count
+        FROM segments s;
     """
     
-    cur.execute(query)
-    result = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(query, (start_node, end_node))
+        result = cur.fetchone()
     
-    if result and result['geojson']:
-        return jsonify(result['geojson'])
+    # Postgres already rendered the GeoJSON, so pass the text straight through
+    if result and result['segment_count']:
+        return Response(result['geojson'], mimetype='application/json')
     else:
         return jsonify({'error': 'No route found'}), 404
 
 @app.route('/api/nodes/random', methods=['GET'])
 def get_random_nodes():
     """Get two random connected nodes for testing"""
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
+    # Sample ~1% of the table's pages rather than sorting every vertex
     query = """
         SELECT 
             id,
             ST_Y(the_geom) as lat,
             ST_X(the_geom) as lon
-        FROM ways_vertices_pgr
+        FROM ways_vertices_pgr TABLESAMPLE SYSTEM (1)
         WHERE cnt >= 3
         ORDER BY RANDOM()
         LIMIT 2;
     """
     
-    cur.execute(query)
-    nodes = cur.fetchall()
+    # Small graphs can come back with too few sampled rows
+    fallback_query = """
+        SELECT 
+            id,
+            ST_Y(the_geom) as lat,
+            ST_X(the_geom) as lon
+        FROM ways_vertices_pgr
+        WHERE cnt >= 3
+        ORDER BY RANDOM()
+        LIMIT 2;
+    """
     
-    cur.close()
-    conn.close()
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(query)
+        nodes = cur.fetchall()
+        
+        if len(nodes) < 2:
+            cur.execute(fallback_query)
+            nodes = cur.fetchall()
     
     return jsonify(nodes)
 
 @app.route('/api/elevation-profile', methods=['GET'])
 def get_elevation_profile():
-    """Get elevation profile for a route"""
+    """Get elevation profile for a route
+    
+    Uses the same costs as /api/route, so the profile follows the same path.
+    """
     start_node = request.args.get('start', type=int)
     end_node = request.args.get('end', type=int)
+    route_type = request.args.get('type', 'fastest')  # 'fastest' or 'safest'
     
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    if not start_node or not end_node:
+        return jsonify({'error': 'Missing start or end node'}), 400
+    
+    cost_column = route_cost_column(route_type)
     
     query = f"""
         WITH route AS (
             SELECT * FROM pgr_dijkstra(
-                'SELECT gid as id, source, target, length_m as cost FROM ways',
-                {start_node}, {end_node}, false
+                'SELECT id, source, target, {cost_column} as cost FROM ways_costed',
+                %s, %s, false
             )
         )
         SELECT 
             r.seq,
-            w.name,
-            se.elevation_start_m,
-            se.elevation_end_m,
-            se.grade_percent,
-            w.length_m,
-            SUM(w.length_m) OVER (ORDER BY r.seq) as cumulative_distance_m
+            wc.name,
+            wc.elevation_start_m,
+            wc.elevation_end_m,
+            wc.grade_percent,
+            wc.length_m,
+            SUM(wc.length_m) OVER (ORDER BY r.seq) as cumulative_distance_m
         FROM route r
-        JOIN ways w ON r.edge = w.gid
-        LEFT JOIN segment_elevation se ON w.gid = se.segment_id
+        JOIN ways_costed wc ON r.edge = wc.id
         WHERE r.edge IS NOT NULL
         ORDER BY r.seq;
     """
     
-    cur.execute(query)
-    profile = cur.fetchall()
-    
-    cur.close()
-    conn.close()
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(query, (start_node, end_node))
+        profile = cur.fetchall()
     
     return jsonify(profile)
 